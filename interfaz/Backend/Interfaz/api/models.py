@@ -68,6 +68,11 @@ class Product(models.Model):
     )
     unit = models.CharField(max_length=10, choices=UNIT_CHOICES, default='unidades')
 
+    @property
+    def estado(self):
+        # Activo si stock > 0, Inactivo si stock == 0
+        return 'Activo' if self.stock > 0 else 'Inactivo'
+
     def __str__(self):
         return self.name
 
@@ -1,15 +1,46 @@
 # backend/api/serializers.py
+import copy
+import logging
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
+from django.db import models, transaction
+from django.db.models import Case, F, Prefetch, When
+from django.db.models.expressions import RawSQL
 from .models import (
     Product, CashMovement, InventoryChange, Sale, SaleItem, Role, 
-    UserQuery, Supplier, UserStorage, LowStockReport, RecipeIngredient
+    UserQuery, Supplier, UserStorage, LowStockReport, RecipeIngredient, InventoryChangeAudit
 )
 from .models import Purchase
 from .models import Order, OrderItem
 
 User = get_user_model()  # Usa el modelo de usuario personalizado
 
+logger = logging.getLogger(__name__)
+
+DECIMAL_ZERO = Decimal('0')
+
+# Base para serializers que se usan en endpoints con mucho tráfico
+class CachedFieldsModelSerializer(serializers.ModelSerializer):
+    """ModelSerializer que construye sus campos una sola vez por clase.
+
+    Cada instancia recibe copias superficiales de los campos cacheados; los
+    serializers anidados se copian en profundidad para no compartir estado.
+    """
+    _fields_cache = {}
+
+    def get_fields(self):
+        cls = type(self)
+        cached = CachedFieldsModelSerializer._fields_cache.get(cls)
+        if cached is None:
+            cached = CachedFieldsModelSerializer._fields_cache[cls] = super().get_fields()
+        return {
+            name: copy.deepcopy(field) if isinstance(field, serializers.BaseSerializer) else copy.copy(field)
+            for name, field in cached.items()
+        }
+
 # Serializer para el modelo de proveedor
 class SupplierSerializer(serializers.ModelSerializer):
     class Meta:
@@ -60,6 +91,13 @@ class UserUpdateSerializer(serializers.ModelSerializer):
         return instance
 
 
+# Los roles son un conjunto fijo y pequeño: se resuelven una vez por proceso
+@lru_cache(maxsize=32)
+def get_role_id(role_name):
+    role, created = Role.objects.get_or_create(name=role_name)
+    return role.id
+
+
 # Serializer para crear usuarios (incluye el campo de contraseña)
 class UserCreateSerializer(serializers.ModelSerializer):
     role_name = serializers.CharField(write_only=True)
@@ -72,14 +110,11 @@ class UserCreateSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         role_name = validated_data.pop('role_name', 'Cajero')
         
-        # Buscar o crear el rol
-        role, created = Role.objects.get_or_create(name=role_name)
-        
         user = User.objects.create_user(
             username=validated_data['username'],
             email=validated_data['email'],
             password=validated_data['password'],
-            role=role
+            role_id=get_role_id(role_name)
         )
         return user
 
@@ -92,6 +127,13 @@ class RecipeIngredientSerializer(serializers.ModelSerializer):
         fields = ['id', 'product', 'ingredient', 'ingredient_name', 'quantity', 'unit']
         read_only_fields = ['product']
 
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        """Trae del insumo solo el nombre, sin la fila completa del producto."""
+        return queryset.select_related('ingredient').only(
+            'id', 'product', 'ingredient', 'quantity', 'unit', 'ingredient__name'
+        )
+
 # Serializer for writing recipe ingredients
 class RecipeIngredientWriteSerializer(serializers.ModelSerializer):
     class Meta:
@@ -99,8 +141,8 @@ class RecipeIngredientWriteSerializer(serializers.ModelSerializer):
         fields = ['ingredient', 'quantity', 'unit']
 
 # Serializer para el modelo de producto
-class ProductSerializer(serializers.ModelSerializer):
-    estado = serializers.SerializerMethodField()
+class ProductSerializer(CachedFieldsModelSerializer):
+    estado = serializers.CharField(read_only=True)
     recipe = RecipeIngredientSerializer(many=True, read_only=True)
     recipe_ingredients = RecipeIngredientWriteSerializer(many=True, write_only=True, required=False)
 
@@ -108,12 +150,13 @@ class ProductSerializer(serializers.ModelSerializer):
         model = Product
         fields = ['id', 'name', 'description', 'price', 'stock', 'low_stock_threshold', 'category', 'is_ingredient', 'unit', 'recipe', 'recipe_ingredients', 'estado']
 
-    def get_estado(self, obj):
-        # Lógica: Activo si stock > 0, Inactivo si stock == 0
-        if obj.stock > 0:
-            return 'Activo'
-        return 'Inactivo'
-    
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        """Precarga la receta y sus insumos. Las vistas deben llamarlo en get_queryset."""
+        return queryset.prefetch_related(
+            Prefetch('recipe', queryset=RecipeIngredientSerializer.setup_eager_loading(RecipeIngredient.objects.all()))
+        )
+
     def validate_name(self, value):
         if not value or not value.strip():
             raise serializers.ValidationError("El nombre del producto es obligatorio.")
@@ -135,8 +178,6 @@ class ProductSerializer(serializers.ModelSerializer):
         return value
 
     def create(self, validated_data):
-        from django.db import transaction
-        
         recipe_data = validated_data.pop('recipe_ingredients', [])
         initial_stock = validated_data.get('stock', 0)
 
@@ -144,11 +185,16 @@ class ProductSerializer(serializers.ModelSerializer):
             product = Product.objects.create(**validated_data)
 
             # Create recipe links
-            for item_data in recipe_data:
-                RecipeIngredient.objects.create(product=product, **item_data)
+            RecipeIngredient.objects.bulk_create(
+                [RecipeIngredient(product=product, **item_data) for item_data in recipe_data]
+            )
 
             # If the created product has an initial stock, deduct ingredients from inventory
             if initial_stock > 0:
+                # Lock all ingredients for update in a single query
+                ing_ids = [item_data['ingredient'].pk for item_data in recipe_data if item_data.get('ingredient')]
+                ingredients = {p.pk: p for p in Product.objects.select_for_update().filter(pk__in=ing_ids)}
+
                 for item_data in recipe_data:
                     ingredient = item_data.get('ingredient')
                     quantity_per_unit = item_data.get('quantity')
@@ -157,74 +203,86 @@ class ProductSerializer(serializers.ModelSerializer):
                         continue
 
                     total_ingredient_needed = quantity_per_unit * initial_stock
-                    
-                    # Lock ingredient for update and deduct stock
-                    ingredient_to_update = Product.objects.select_for_update().get(pk=ingredient.pk)
+                    ingredient_to_update = ingredients[ingredient.pk]
 
                     if ingredient_to_update.stock < total_ingredient_needed:
                         raise serializers.ValidationError(
                             f"No hay suficiente stock para el insumo '{ingredient.name}'. "
                             f"Necesario: {total_ingredient_needed}, Disponible: {ingredient_to_update.stock}"
                         )
-                    
+
                     ingredient_to_update.stock -= total_ingredient_needed
-                    ingredient_to_update.save()
+
+                Product.objects.bulk_update(ingredients.values(), ['stock'])
 
         return product
 
     def update(self, instance, validated_data):
         recipe_data = validated_data.pop('recipe_ingredients', None)
-        instance = super().update(instance, validated_data)
 
-        if recipe_data is not None:
-            # Clear existing recipe and create new one
-            instance.recipe.all().delete()
-            for recipe_item_data in recipe_data:
-                RecipeIngredient.objects.create(product=instance, **recipe_item_data)
-        
+        with transaction.atomic():
+            instance = super().update(instance, validated_data)
+
+            if recipe_data is not None:
+                # Clear existing recipe and create new one
+                RecipeIngredient.objects.filter(product=instance).delete()
+                RecipeIngredient.objects.bulk_create(
+                    [RecipeIngredient(product=instance, **recipe_item_data) for recipe_item_data in recipe_data],
+                    batch_size=500
+                )
+
         return instance
 
 # Serializer para el modelo de movimiento de caja
 class CashMovementSerializer(serializers.ModelSerializer):
    
-    user = serializers.ReadOnlyField(source='user.username')
+    user = serializers.SlugRelatedField(read_only=True, slug_field='username')
     
     class Meta:
         model = CashMovement
         fields = ('id', 'type', 'amount', 'description', 'timestamp', 'user', 'payment_method')
         read_only_fields = ('user',)
 
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        """Precarga el usuario. Las vistas deben llamarlo en get_queryset."""
+        return queryset.select_related('user')
+
 # Serializer para el modelo de cambio de inventario
-class InventoryChangeSerializer(serializers.ModelSerializer):
-    user = serializers.ReadOnlyField(source='user.username')
+class InventoryChangeSerializer(CachedFieldsModelSerializer):
+    user = serializers.SlugRelatedField(read_only=True, slug_field='username')
     
     class Meta:
         model = InventoryChange
         fields = '__all__'
         read_only_fields = ('user',)
 
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        """Precarga el usuario. Las vistas deben llamarlo en get_queryset."""
+        return queryset.select_related('user')
+
     def validate(self, attrs):
         # Normalize quantity: accept negative for 'Salida' but store positive
-        from decimal import Decimal, InvalidOperation
         change_type = attrs.get('type') or getattr(self.instance, 'type', None)
         qty = attrs.get('quantity')
         if qty is None:
             raise serializers.ValidationError({'quantity': 'La cantidad es requerida.'})
 
-        try:
-            qty_decimal = Decimal(str(qty))
-        except InvalidOperation:
-            raise serializers.ValidationError({'quantity': 'Cantidad inválida.'})
+        if isinstance(qty, Decimal):
+            qty_decimal = qty
+        else:
+            try:
+                qty_decimal = Decimal(str(qty))
+            except InvalidOperation:
+                raise serializers.ValidationError({'quantity': 'Cantidad inválida.'})
 
         if change_type == 'Salida' and qty_decimal > 0:
             # allow frontend to send negative; but accept positive and interpret as exit
             # we will treat quantity as absolute value when applying
             pass
 
-        if qty_decimal < 0:
-            qty_decimal = abs(qty_decimal)
-
-        attrs['quantity'] = qty_decimal
+        attrs['quantity'] = -qty_decimal if qty_decimal < 0 else qty_decimal
         return attrs
 
 
@@ -236,10 +294,26 @@ class SaleItemSerializer(serializers.ModelSerializer):
         model = SaleItem
         fields = ('product', 'product_name', 'quantity', 'price')
 
+    def to_representation(self, instance):
+        # Esquema fijo: se arma el dict directamente en lugar de recorrer los campos por cada línea.
+        # Requiere 'product' precargado (ver SaleSerializer.setup_eager_loading)
+        return {
+            'product': instance.product_id,
+            'product_name': instance.product.name,
+            'quantity': instance.quantity,
+            'price': self.fields['price'].to_representation(instance.price),
+        }
+
+# Serializer para recibir los items de una venta desde el frontend
+class SaleItemInputSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField()
+    quantity = serializers.IntegerField()
+    price = serializers.DecimalField(max_digits=10, decimal_places=2)
+
 # Serializer para el modelo de venta
-class SaleSerializer(serializers.ModelSerializer):
-    user = serializers.ReadOnlyField(source='user.username')
-    items = serializers.ListField(write_only=True, required=False)  # Para recibir los items del frontend
+class SaleSerializer(CachedFieldsModelSerializer):
+    user = serializers.SlugRelatedField(read_only=True, slug_field='username')
+    items = SaleItemInputSerializer(many=True, write_only=True, required=False)  # Para recibir los items del frontend
     sale_items = SaleItemSerializer(source='saleitem_set', many=True, read_only=True)  # Para mostrar los items
 
     class Meta:
@@ -247,74 +321,124 @@ class SaleSerializer(serializers.ModelSerializer):
         fields = ('id', 'timestamp', 'total_amount', 'payment_method', 'user', 'items', 'sale_items')
         read_only_fields = ('user',)
 
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        """Precarga usuario e items con su producto. Las vistas deben llamarlo en get_queryset."""
+        return queryset.select_related('user').prefetch_related(
+            Prefetch('saleitem_set', queryset=SaleItem.objects.select_related('product'))
+        )
+
     def create(self, validated_data):
         items_data = validated_data.pop('items', [])
-        sale = Sale.objects.create(**validated_data)
-        
-        # Procesar cada item de la venta
-        for item_data in items_data:
-            product_id = item_data.get('product_id')
-            quantity = item_data.get('quantity')
-            price = item_data.get('price')
-            
-            try:
-                product = Product.objects.get(id=product_id)
-                
-                # Verificar que hay suficiente stock
-                if product.stock < quantity:
-                    raise serializers.ValidationError(f'Stock insuficiente para {product.name}. Disponible: {product.stock}, Requerido: {quantity}')
-                
-                # Crear el item de venta
-                SaleItem.objects.create(
-                    sale=sale,
-                    product=product,
-                    quantity=quantity,
-                    price=price
-                )
-                
-                # Actualizar el stock del producto
-                product.stock -= quantity
-                product.save()
-                
-                print(f'✅ Stock actualizado: {product.name} - Nuevo stock: {product.stock}')
-                
-            except Product.DoesNotExist:
-                raise serializers.ValidationError(f'Producto con ID {product_id} no encontrado')
-        
+
+        with transaction.atomic():
+            # Bloquear todos los productos de la venta en una sola consulta
+            product_ids = {item_data['product_id'] for item_data in items_data}
+            products = Product.objects.select_for_update().in_bulk(product_ids)
+
+            lines = []
+            requested = {}
+            for item_data in items_data:
+                product_id = item_data['product_id']
+                quantity = item_data['quantity']
+
+                product = products.get(product_id)
+                if product is None:
+                    raise serializers.ValidationError(f'Producto con ID {product_id} no encontrado')
+
+                lines.append((product, quantity, item_data['price']))
+                requested[product_id] = requested.get(product_id, 0) + quantity
+
+            # Verificar que hay suficiente stock antes de escribir nada
+            shortages = [
+                f'Stock insuficiente para {products[product_id].name}. Disponible: {products[product_id].stock}, Requerido: {quantity}'
+                for product_id, quantity in requested.items() if products[product_id].stock < quantity
+            ]
+            if shortages:
+                raise serializers.ValidationError(shortages)
+
+            sale = Sale.objects.create(**validated_data)
+
+            # Crear los items en lote
+            SaleItem.objects.bulk_create(
+                [SaleItem(sale=sale, product=product, quantity=quantity, price=price) for product, quantity, price in lines],
+                batch_size=1000
+            )
+
+            # Descontar el stock en la base de datos con un único UPDATE relativo
+            if requested:
+                Product.objects.filter(pk__in=requested).update(stock=Case(
+                    *[When(pk=product_id, then=F('stock') - quantity) for product_id, quantity in requested.items()],
+                    output_field=models.DecimalField(max_digits=10, decimal_places=2),
+                ))
+                logger.debug('Stock actualizado por la venta %s: %s', sale.id, requested)
+
         return sale
 
 # Serializer para consultas de usuario
 class UserQuerySerializer(serializers.ModelSerializer):
-    user = serializers.ReadOnlyField(source='user.username')
+    user = serializers.SlugRelatedField(read_only=True, slug_field='username')
     
     class Meta:
         model = UserQuery
         fields = '__all__'
         read_only_fields = ('user', 'created_at', 'updated_at')
 
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        """Precarga el usuario. Las vistas deben llamarlo en get_queryset."""
+        return queryset.select_related('user')
+
+
+# Total de una compra calculado en PostgreSQL a partir de su JSON de items.
+# Replica get_total: se omiten las líneas sin cantidad, sin precio o no numéricas.
+PURCHASE_ITEMS_TOTAL_SQL = r"""
+    CASE WHEN jsonb_typeof("{table}"."items") = 'array' THEN (
+        SELECT COALESCE(SUM(line.qty::numeric * line.price::numeric), 0)
+        FROM (
+            SELECT COALESCE(NULLIF(i->>'quantity', ''), NULLIF(i->>'qty', '')) AS qty,
+                   COALESCE(NULLIF(i->>'unitPrice', ''), NULLIF(i->>'unit_price', ''), NULLIF(i->>'price', '')) AS price
+            FROM jsonb_array_elements("{table}"."items") AS i
+        ) AS line
+        WHERE line.qty ~ '^\s*[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)\s*$'
+          AND line.price ~ '^\s*[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)\s*$'
+    ) ELSE "{table}"."total_amount" END
+""".format(table=Purchase._meta.db_table)
 
 # Serializer para compras
-class PurchaseSerializer(serializers.ModelSerializer):
-    user = serializers.ReadOnlyField(source='user.username')
-    approved_by = serializers.ReadOnlyField(source='approved_by.username', allow_null=True)
-    approved_by_name = serializers.ReadOnlyField(source='approved_by.username', allow_null=True)
+class PurchaseSerializer(CachedFieldsModelSerializer):
+    user = serializers.SlugRelatedField(read_only=True, slug_field='username')
+    approved_by = serializers.SlugRelatedField(read_only=True, slug_field='username')
     supplier_name = serializers.ReadOnlyField(source='supplier')
     total = serializers.SerializerMethodField()
 
     class Meta:
         model = Purchase
-        fields = '__all__'
+        fields = ('id', 'date', 'supplier', 'supplier_id', 'supplier_name', 'items', 'total_amount', 'total', 'status', 'created_at', 'user', 'approved_by', 'approved_at')
         read_only_fields = ('id', 'created_at', 'user', 'status', 'approved_by', 'approved_at')
 
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        """Precarga usuarios y calcula el total en la base de datos. Las vistas deben llamarlo en get_queryset."""
+        return queryset.select_related('user', 'approved_by').annotate(
+            items_total=RawSQL(PURCHASE_ITEMS_TOTAL_SQL, [])
+        )
+
     def get_total(self, obj):
-        from decimal import Decimal
+        # Listados: el total ya viene calculado por setup_eager_loading
+        if hasattr(obj, 'items_total'):
+            return obj.items_total
         if isinstance(obj.items, list):
-            total = Decimal('0')
+            D = Decimal
+            total = DECIMAL_ZERO
             for item in obj.items:
-                qty = item.get('quantity') or item.get('qty') or 0
-                unit_price = item.get('unitPrice') or item.get('unit_price') or item.get('price') or 0
+                qty = item.get('quantity') or item.get('qty')
+                unit_price = item.get('unitPrice') or item.get('unit_price') or item.get('price')
+                # Las líneas sin cantidad o sin precio no suman al total
+                if not (qty and unit_price):
+                    continue
                 try:
-                    total += Decimal(str(qty)) * Decimal(str(unit_price))
+                    total += D(str(qty)) * D(str(unit_price))
                 except Exception:
                     continue
             return total
@@ -326,46 +450,70 @@ class OrderItemSerializer(serializers.ModelSerializer):
         model = OrderItem
         fields = ('id', 'product_name', 'quantity', 'unit_price', 'total')
 
+    def to_representation(self, instance):
+        # Esquema fijo: se arma el dict directamente en lugar de recorrer los campos por cada línea
+        fields = self.fields
+        return {
+            'id': instance.id,
+            'product_name': instance.product_name,
+            'quantity': instance.quantity,
+            'unit_price': fields['unit_price'].to_representation(instance.unit_price),
+            'total': fields['total'].to_representation(instance.total),
+        }
+
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(CachedFieldsModelSerializer):
     items = OrderItemSerializer(many=True)
-    user = serializers.ReadOnlyField(source='user.username')
+    user = serializers.SlugRelatedField(read_only=True, slug_field='username')
 
     class Meta:
         model = Order
         fields = ('id', 'customer_name', 'date', 'payment_method', 'items', 'total_amount', 'notes', 'status', 'created_at', 'user')
         read_only_fields = ('id', 'created_at', 'user')
 
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        """Precarga usuario e items del pedido. Las vistas deben llamarlo en get_queryset."""
+        return queryset.select_related('user').prefetch_related('items')
+
     def create(self, validated_data):
         items_data = validated_data.pop('items', [])
+        lines = [(item.get('product_name', ''), item.get('quantity', 1), item.get('unit_price', 0)) for item in items_data]
+        # El total se calcula antes de crear el pedido para guardarlo una sola vez
+        validated_data['total_amount'] = sum(qty * unit for _, qty, unit in lines)
         order = Order.objects.create(**validated_data)
-        total = 0
-        for item in items_data:
-            qty = item.get('quantity', 1)
-            unit = item.get('unit_price', 0)
-            line_total = qty * unit
-            OrderItem.objects.create(order=order, product_name=item.get('product_name', ''), quantity=qty, unit_price=unit, total=line_total)
-            total += line_total
-        order.total_amount = total
-        order.save()
+        OrderItem.objects.bulk_create(
+            [OrderItem(order=order, product_name=name, quantity=qty, unit_price=unit, total=qty * unit) for name, qty, unit in lines],
+            batch_size=1000
+        )
         return order
 
 
 # Serializer para auditoría de cambios de inventario (restaurado)
-class InventoryChangeAuditSerializer(serializers.ModelSerializer):
-    user = serializers.ReadOnlyField(source='user.username')
+class InventoryChangeAuditSerializer(CachedFieldsModelSerializer):
+    user = serializers.SlugRelatedField(read_only=True, slug_field='username')
     product_name = serializers.ReadOnlyField(source='product.name')
 
     class Meta:
-        model = getattr(__import__('api.models', fromlist=['InventoryChangeAudit']), 'InventoryChangeAudit')
+        model = InventoryChangeAudit
         fields = ('id', 'inventory_change', 'product', 'product_name', 'user', 'role', 'change_type', 'quantity', 'previous_stock', 'new_stock', 'reason', 'timestamp')
         read_only_fields = ('id', 'inventory_change', 'product_name', 'user', 'previous_stock', 'new_stock', 'timestamp')
 
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        """Precarga usuario y producto. Las vistas deben llamarlo en get_queryset."""
+        return queryset.select_related('user', 'product')
+
 class LowStockReportSerializer(serializers.ModelSerializer):
-    reported_by = serializers.ReadOnlyField(source='reported_by.username')
+    reported_by = serializers.SlugRelatedField(read_only=True, slug_field='username')
     product_name = serializers.ReadOnlyField(source='product.name')
 
     class Meta:
         model = LowStockReport
         fields = ('id', 'product', 'product_name', 'message', 'reported_by', 'created_at', 'is_resolved')
         read_only_fields = ('id', 'reported_by', 'created_at')
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        """Precarga quién reportó y el producto. Las vistas deben llamarlo en get_queryset."""
+        return queryset.select_related('reported_by', 'product')
@@ -1,5 +1,6 @@
 from rest_framework import viewsets, status, generics
 from rest_framework.views import APIView
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes, action
 from rest_framework.permissions import IsAuthenticated, AllowAny
@@ -7,7 +8,7 @@ from rest_framework.permissions import SAFE_METHODS, BasePermission
 from django.shortcuts import get_object_or_404
 from django.contrib.auth import get_user_model, authenticate
 from rest_framework_simplejwt.tokens import RefreshToken
-from .models import Product, CashMovement, InventoryChange, Sale, UserQuery, Supplier, Role, LowStockReport, RecipeIngredient
+from .models import Product, CashMovement, InventoryChange, InventoryChangeAudit, Sale, UserQuery, Supplier, Role, LowStockReport, RecipeIngredient
 from django.conf import settings
 from django.utils import timezone
 from .serializers import (
@@ -18,7 +19,9 @@ from .serializers import (
 )
 from .models import UserStorage
 from django.db import transaction
+from django.db.models import Q
 from decimal import Decimal
+import logging
 
 # Permiso personalizado para rol de Gerente
 class IsGerente(BasePermission):
@@ -57,11 +60,17 @@ class LowStockReportListView(generics.ListAPIView):
     serializer_class = LowStockReportSerializer
     permission_classes = [IsAuthenticated, IsGerente]
 
+    def get_queryset(self):
+        return LowStockReportSerializer.setup_eager_loading(super().get_queryset())
+
 class LowStockReportUpdateView(generics.UpdateAPIView):
     queryset = LowStockReport.objects.all()
     serializer_class = LowStockReportSerializer
     permission_classes = [IsAuthenticated, IsGerente]
 
+    def get_queryset(self):
+        return LowStockReportSerializer.setup_eager_loading(super().get_queryset())
+
 # ViewSet para Roles (solo lectura)
 class RoleViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Role.objects.all()
@@ -142,10 +151,11 @@ from reportlab.lib import colors
 from django.http import HttpResponse
 from io import BytesIO
 import json
-from decimal import Decimal
 
 User = get_user_model()
 
+logger = logging.getLogger(__name__)
+
 # Vista de login mejorada
 @api_view(['POST'])
 @permission_classes([AllowAny])
@@ -332,6 +342,9 @@ class ProductListCreate(generics.ListCreateAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
 
+    def get_queryset(self):
+        return ProductSerializer.setup_eager_loading(super().get_queryset())
+
 class UserListCreate(generics.ListCreateAPIView):
     queryset = User.objects.all()
     permission_classes = [AllowAny]  # Permitir creación sin autenticación por ahora
@@ -397,6 +410,9 @@ class ProductViewSet(viewsets.ModelViewSet):
     serializer_class = ProductSerializer
     permission_classes = [IsAuthenticated]
 
+    def get_queryset(self):
+        return ProductSerializer.setup_eager_loading(super().get_queryset())
+
 
 class RecipeIngredientViewSet(viewsets.ModelViewSet):
     serializer_class = RecipeIngredientSerializer
@@ -404,7 +420,7 @@ class RecipeIngredientViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        queryset = super().get_queryset()
+        queryset = RecipeIngredientSerializer.setup_eager_loading(super().get_queryset())
         product_id = self.request.query_params.get('product_id')
         if product_id:
             queryset = queryset.filter(product_id=product_id)
@@ -437,15 +453,18 @@ class PurchaseViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         user = self.request.user
+        queryset = Purchase.objects.none()
         if user.is_authenticated:
             # Gerente sees all purchases
             if hasattr(user, 'role') and user.role and user.role.name == 'Gerente':
-                return Purchase.objects.all()
+                queryset = Purchase.objects.all()
             # Encargado sees all approved purchases (history) and their own pending ones
-            if hasattr(user, 'role') and user.role and user.role.name == 'Encargado':
-                from django.db.models import Q
-                return Purchase.objects.filter(Q(status='Aprobada') | Q(user=user, status='Pendiente'))
-        return Purchase.objects.none()
+            elif hasattr(user, 'role') and user.role and user.role.name == 'Encargado':
+                queryset = Purchase.objects.filter(Q(status='Aprobada') | Q(user=user, status='Pendiente'))
+        # Only listings use the database-computed total; writes must recompute it from the saved items
+        if self.action == 'list':
+            queryset = PurchaseSerializer.setup_eager_loading(queryset)
+        return queryset
 
     def get_permissions(self):
         if self.action == 'create':
@@ -457,8 +476,6 @@ class PurchaseViewSet(viewsets.ModelViewSet):
         return super().get_permissions()
 
     def perform_create(self, serializer):
-        from django.db import transaction
-
         user = self.request.user
         role_name = user.role.name if hasattr(user, 'role') and user.role else None
 
@@ -564,7 +581,7 @@ class PurchaseViewSet(viewsets.ModelViewSet):
                                 raise ValueError(f"No se puede convertir de '{purchase_unit}' a '{product_base_unit}' para el producto '{product.name}'.")
 
                         product.stock += base_quantity
-                        product.save()
+                        product.save(update_fields=['stock'])
         except Exception as e:
             raise e
 
@@ -573,7 +590,9 @@ class PurchaseViewSet(viewsets.ModelViewSet):
         """
         Endpoint para que los Gerentes vean todas las solicitudes de compra pendientes.
         """
-        pending_purchases = Purchase.objects.filter(status='Pendiente').order_by('-created_at')
+        pending_purchases = PurchaseSerializer.setup_eager_loading(
+            Purchase.objects.filter(status='Pendiente').order_by('-created_at')
+        )
         
         page = self.paginate_queryset(pending_purchases)
         if page is not None:
@@ -589,10 +608,9 @@ class PurchaseViewSet(viewsets.ModelViewSet):
         Endpoint para que Gerentes y Encargados vean el historial de compras aprobadas y completadas.
         """
         # Gerentes y Encargados pueden ver todas las compras aprobadas y completadas
-        from django.db.models import Q
-        completed_purchases = Purchase.objects.filter(
-            Q(status='Aprobada') | Q(status='Completada')
-        ).order_by('-created_at')
+        completed_purchases = PurchaseSerializer.setup_eager_loading(
+            Purchase.objects.filter(Q(status='Aprobada') | Q(status='Completada')).order_by('-created_at')
+        )
         
         page = self.paginate_queryset(completed_purchases)
         if page is not None:
@@ -607,11 +625,6 @@ class PurchaseViewSet(viewsets.ModelViewSet):
         """
         Approve a purchase request. Only for 'Gerente'.
         """
-        import logging
-        logger = logging.getLogger(__name__)
-
-        from django.db import transaction
-
         purchase = self.get_object()
         logger.info(f'Approving purchase {purchase.id}, current status: {purchase.status}')
 
@@ -686,7 +699,7 @@ class PurchaseViewSet(viewsets.ModelViewSet):
                                     raise ValueError(f"No se puede convertir de '{purchase_unit}' a '{product_base_unit}' para el producto '{product.name}'.")
 
                             product.stock += base_quantity
-                            product.save()
+                            product.save(update_fields=['stock'])
                             logger.info(f"Updated product {product.id} stock: +{base_quantity} ({quantity} {purchase_unit}), new stock: {product.stock}")
                         
                         except Product.DoesNotExist:
@@ -727,6 +740,9 @@ class OrderViewSet(viewsets.ModelViewSet):
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated]
 
+    def get_queryset(self):
+        return OrderSerializer.setup_eager_loading(super().get_queryset())
+
     def perform_create(self, serializer):
         try:
             serializer.save(user=self.request.user if self.request.user.is_authenticated else None)
@@ -741,6 +757,9 @@ class CashMovementViewSet(viewsets.ModelViewSet):
     serializer_class = CashMovementSerializer
     permission_classes = [IsAuthenticated]
 
+    def get_queryset(self):
+        return CashMovementSerializer.setup_eager_loading(super().get_queryset())
+
     def perform_create(self, serializer):
         try:
             # Log minimal info for diagnostics (no token values)
@@ -765,11 +784,11 @@ class InventoryChangeViewSet(viewsets.ModelViewSet):
     serializer_class = InventoryChangeSerializer
     permission_classes = [IsAuthenticated]
 
+    def get_queryset(self):
+        return InventoryChangeSerializer.setup_eager_loading(super().get_queryset())
+
     def perform_create(self, serializer):
         # Realizar la operación de cambio de inventario de forma atómica
-        from django.db import transaction
-        from django.shortcuts import get_object_or_404
-
         product = serializer.validated_data['product']
         quantity = serializer.validated_data['quantity']
         change_type = serializer.validated_data['type']
@@ -784,7 +803,6 @@ class InventoryChangeViewSet(viewsets.ModelViewSet):
             role_name = None
 
         if role_name != 'Gerente':
-            from rest_framework.exceptions import PermissionDenied
             raise PermissionDenied(detail='Permiso denegado: se requiere rol Gerente para modificar inventario')
 
         with transaction.atomic():
@@ -799,24 +817,21 @@ class InventoryChangeViewSet(viewsets.ModelViewSet):
                
                 # Validar que la cantidad sea un número entero si el producto no es un insumo
                 if not p.is_ingredient and quantity % 1 != 0:
-                        from rest_framework.exceptions import ValidationError
                         raise ValidationError({'detail': 'La cantidad para productos no insumos debe ser un número entero.'})
 
                 if previous_stock < quantity:
-                    from rest_framework.exceptions import ValidationError
                     raise ValidationError({'detail': 'La salida supera el stock disponible.'})
                 new_stock = previous_stock - quantity
 
             # Apply stock change
             p.stock = new_stock
-            p.save()
+            p.save(update_fields=['stock'])
 
             # Save the InventoryChange record with current user
             inv_change = serializer.save(user=self.request.user)
 
             # Crear registro de auditoría
             try:
-                from .models import InventoryChangeAudit
                 InventoryChangeAudit.objects.create(
                     inventory_change=inv_change,
                     product=p,
@@ -835,12 +850,12 @@ class InventoryChangeViewSet(viewsets.ModelViewSet):
 
 # ViewSet para auditoría de cambios de inventario (solo lectura)
 class InventoryChangeAuditViewSet(viewsets.ReadOnlyModelViewSet):
-    queryset = getattr(__import__('api.models', fromlist=['InventoryChangeAudit']), 'InventoryChangeAudit').objects.all()
+    queryset = InventoryChangeAudit.objects.all()
     serializer_class = InventoryChangeAuditSerializer
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        qs = super().get_queryset()
+        qs = InventoryChangeAuditSerializer.setup_eager_loading(super().get_queryset())
         # Filtrado opcional por producto, usuario, tipo o rango de fechas
         product_id = self.request.query_params.get('product')
         user_id = self.request.query_params.get('user')
@@ -867,6 +882,9 @@ class SaleViewSet(viewsets.ModelViewSet):
     serializer_class = SaleSerializer
     permission_classes = [IsAuthenticated]
 
+    def get_queryset(self):
+        return SaleSerializer.setup_eager_loading(super().get_queryset())
+
     def perform_create(self, serializer):
         # El serializer ya maneja la lógica de actualización de stock
         try:
@@ -888,7 +906,7 @@ class UserQueryViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         # Solo mostrar las consultas del usuario actual
-        qs = UserQuery.objects.filter(user=self.request.user)
+        qs = UserQuerySerializer.setup_eager_loading(UserQuery.objects.filter(user=self.request.user))
         # Permitir filtrar por query_type desde query params (por ejemplo: ?query_type=ventas)
         qtype = self.request.query_params.get('query_type')
         if qtype:
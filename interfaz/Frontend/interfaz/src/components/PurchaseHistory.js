@@ -41,7 +41,7 @@ const PurchaseHistory = ({ purchases, onDeletePurchase, confirmDelete, onCancelD
                             </div>
                             <div className="history-field">${(purchase.total || purchase.total_amount || 0).toFixed(2)}</div>
                             <div className="history-field">{purchase.status}</div>
-                            <div className="history-field">{purchase.approved_by_name || 'N/A'}</div>
+                            <div className="history-field">{purchase.approved_by || 'N/A'}</div>
 
                             {userRole === 'Gerente' && (
                                 <div className="history-field actions-col">